@@ -3,11 +3,13 @@ This script contains the method
 """
 
 import altair as alt
+import numpy as np
 import pandas as pd
 import re
 import textdistance
 
 from ipywidgets import interact, fixed
+from pandas.api.types import is_float_dtype
 from pyvis.network import Network
 
 # pre-assigned relationship weights for different type of relationships
@@ -25,6 +27,9 @@ RELATIONSHIP_WEIGHTS = {
         'Quotation, Mechanical transformation, Non-mechanical transformation':11
         }
 
+# splits melodic intervals such as '-2+3-2' after each direction sign
+_MELODIC_SPLIT_RE = re.compile(r'([+-])(?!$)')
+
 def create_bar_chart(variable, count, color, data, condition, *selectors):
     # if type(data.iloc[0, :][variable]) != str:
     #     raise Exception("Label difficult to see!")
@@ -72,14 +77,15 @@ def _process_ngrams_df_helper(ngrams_df, main_col):
     :param main_col: the name of the property
     :return: a dataframe with ['start', main_col, 'voice'] as columns
     """
-    # copy to avoid changing original ngrams df
-    ngrams_df = ngrams_df.copy()
+    # melt into a new frame first so the original ngrams df is never changed
+    ngrams_df = ngrams_df.melt(value_name=main_col, var_name="voice", ignore_index=False)
 
     # add a start column containing offsets
     ngrams_df.index.name = "start"
-    ngrams_df = ngrams_df.reset_index().melt(id_vars=["start"], value_name=main_col, var_name="voice")
+    ngrams_df = ngrams_df.reset_index()
 
-    ngrams_df["start"] = ngrams_df["start"].astype(float)
+    if not is_float_dtype(ngrams_df["start"]):
+        ngrams_df["start"] = ngrams_df["start"].astype(float, copy=False)
     return ngrams_df
 
 def process_ngrams_df(ngrams_df, ngrams_duration=None, selected_pattern=None, voices=None):
@@ -108,13 +114,14 @@ def process_ngrams_df(ngrams_df, ngrams_duration=None, selected_pattern=None, vo
         ngrams_df['end'] = ngrams_df['start'] + 1
 
     # filter according to voices and patterns (after computing durations for correct offsets)
+    # with one combined mask so the frame is only copied once
+    mask = np.ones(len(ngrams_df), dtype=bool)
     if voices:
-        voice_condition = ngrams_df['voice'].isin(voices)
-        ngrams_df = ngrams_df[voice_condition].dropna(how='all')
-    
+        mask &= ngrams_df['voice'].isin(voices).to_numpy()
     if selected_pattern:
-        pattern_condition = ngrams_df['pattern'].isin(selected_pattern)
-        ngrams_df = ngrams_df[pattern_condition].dropna(how='all')
+        mask &= ngrams_df['pattern'].isin(selected_pattern).to_numpy()
+    if not mask.all():
+        ngrams_df = ngrams_df[mask]
 
     return ngrams_df
 
@@ -137,7 +144,9 @@ def _plot_ngrams_df_heatmap(processed_ngrams_df, heatmap_width=800, heatmap_heig
     # # turns patterns into string to make it easier to see
     # processed_ngrams_df['pattern'] = processed_ngrams_df['pattern'].map(lambda cell: ", ".join(str(item) for item in cell), na_action='ignore').copy()
 
-    patterns_bar = create_bar_chart('pattern', 'count(pattern)', 'pattern', processed_ngrams_df, selector, selector)
+    # count the patterns before plotting so the bar chart only carries one row per pattern
+    pattern_counts = processed_ngrams_df.groupby('pattern', sort=False).size().reset_index(name='count')
+    patterns_bar = create_bar_chart('pattern', 'count', 'pattern', pattern_counts, selector, selector)
     heatmap = create_heatmap('start', 'end', 'voice', 'pattern', processed_ngrams_df, heatmap_width, heatmap_height,
                              selector, selector, tooltip=['start', 'end', 'pattern'])
     return alt.vconcat(patterns_bar, heatmap)
@@ -170,28 +179,24 @@ def _from_ema_to_offsets(df, ema_column):
     :param ema_column: the name of the column storing ema address.
     :return: the processed dataframe with two new columns start and end
     """
-    # retrieve the measures from ema address and create start and end in place
-    df['locations'] = df[ema_column].str.split("/", n=1, expand=True)[0]
-    df['locations'] = df['locations'].str.split(",")
-    df = df.explode('locations', ignore_index=True)
+    # retrieve the measures from ema address, one row for each location
+    measures = df[ema_column].str.split("/", n=1).str[0].reset_index(drop=True)
+    # missing ema addresses get an empty location so stack doesn't drop their rows
+    locations = measures.fillna("").str.split(",", expand=True).stack().replace("", np.nan)
+    df = df.iloc[locations.index.get_level_values(0)].assign(locations=locations.to_numpy()).reset_index(drop=True)
     df[['start', 'end']] = df['locations'].str.split("-", expand=True).fillna(method='ffill')
-    # print(df['start'].to_dict())
-    # print(df['end'].to_dict())
-
-    for index in df['start'].index:
-        try:
-            float(df['start'].loc[index])
-        except:
-            print(str(index) + ":" + df['start'].loc[index]+".")
+    df['start'] = pd.to_numeric(df['start'], errors='coerce').astype('Int64')
+    df['end'] = pd.to_numeric(df['end'], errors='coerce').astype('Int64')
 
-    df['start'] = df['start'].astype(float)
-    df['end'] = df['end'].astype(float)
+    # report the measures that can't be read from the ema address
+    if df[['start', 'end']].isna().any(axis=None):
+        missing = df[['start', 'end']].isna().any(axis=1)
+        print("Unrecognized measures: " + ", ".join(df.loc[missing, 'locations'].astype(str)))
     return df
 
 def _process_crim_json_url(url_column):
     # remove 'data' from http://crimproject.org/data/observations/1/ or http://crimproject.org/data/relationships/5/
-    url_column = url_column.map(lambda cell: cell.replace('data/', ''))
-    return url_column
+    return url_column.str.replace('data/', '', regex=False)
 
 def plot_comparison_heatmap(df, ema_col, main_category='musical_type', other_category='observer.name', option=1,
                             heat_map_width=800, heat_map_height=300):
@@ -210,9 +215,8 @@ def plot_comparison_heatmap(df, ema_col, main_category='musical_type', other_cat
     :return: a big chart containing two smaller bar chart and a heatmap
     """
 
-    df = df.copy()  # create a deep copy of the selected observations to protect the original dataframe
-    df = _from_ema_to_offsets(df, ema_col)
-
+    # only keep the columns the chart uses, selecting them also protects the original dataframe
+    df = df[list(dict.fromkeys(['id', 'url', ema_col, main_category, other_category]))]
     df = _from_ema_to_offsets(df, ema_col)
     df['website_url'] = _process_crim_json_url(df['url'])
 
@@ -232,9 +236,13 @@ def plot_comparison_heatmap(df, ema_col, main_category='musical_type', other_cat
     other_category = new_other_category
     main_category = new_main_category
 
-    bar1 = create_bar_chart(main_category, str('count(' + main_category + ')'), main_category, df,
+    # count the categories before plotting so the bar charts only carry
+    # one row per pair of categories instead of the whole dataframe
+    category_counts = df.groupby([main_category, other_category], dropna=False).size().reset_index(name='count')
+
+    bar1 = create_bar_chart(main_category, 'sum(count)', main_category, category_counts,
                             other_selector | main_selector, main_selector)
-    bar0 = create_bar_chart(other_category, str('count(' + other_category + ')'), main_category, df,
+    bar0 = create_bar_chart(other_category, 'sum(count)', main_category, category_counts,
                             other_selector | main_selector, other_selector)
 
     heatmap = alt.Chart(df).mark_bar().encode(
@@ -284,13 +292,21 @@ def _close_match_helper(cell):
 
 
 def _close_match(ngrams_df, key_pattern):
-    ngrams_df['pattern'] = ngrams_df['pattern'].map(lambda cell: _close_match_helper(cell), na_action='ignore')
+    # process and score every distinct pattern once, then gather the results by row.
+    # the pattern column keeps its original strings, only the scores use the processed patterns
+    codes, uniques = pd.factorize(ngrams_df['pattern'])
+    patterns = [_close_match_helper(cell) for cell in uniques]
+    first_pattern = patterns[codes[0]]
     # making sure that key pattern and other patterns are tuple of string or ints
-    if not (type(ngrams_df.iloc[0, :]['pattern']) == type(key_pattern) == tuple
-            or type(ngrams_df.iloc[0, :]['pattern'][0]) == type(key_pattern[0])):
+    if not (type(first_pattern) == type(key_pattern) == tuple
+            or type(first_pattern[0]) == type(key_pattern[0])):
         raise Exception("Input patterns and patterns inside dataframe aren't tuple of strings/ints")
 
-    ngrams_df['score'] = ngrams_df['pattern'].map(lambda cell: 100*textdistance.levenshtein.normalized_similarity(key_pattern, cell), na_action='ignore')
+    # the trailing NaN is picked up by the -1 codes of missing patterns
+    scores = np.full(len(patterns) + 1, np.nan)
+    for i, pattern in enumerate(patterns):
+        scores[i] = 100 * textdistance.levenshtein.normalized_similarity(key_pattern, pattern)
+    ngrams_df['score'] = scores[codes]
     return ngrams_df
 
 def plot_close_match_heatmap(ngrams_df, key_pattern, ngrams_duration=None, selected_patterns=[], voices=[],
@@ -364,12 +380,8 @@ def process_network_df(df, interval_column_name, ema_column_name):
     """
     Create a small dataframe containing network
     """
-    result_df = pd.DataFrame()
-    result_df[['piece.piece_id', 'url', interval_column_name]] = \
-        df[['piece.piece_id', 'url', interval_column_name]].copy()
-    result_df[['segments']] = \
-        df[ema_column_name].astype(str).str.split("/", 1, expand=True)[0]
-    result_df['segments'] = result_df['segments'].str.split(",")
+    result_df = df[['piece.piece_id', 'url', interval_column_name]].copy()
+    result_df['segments'] = df[ema_column_name].astype(str).str.split("/", n=1).str[0].str.split(",")
     return result_df
 
 # add nodes to graph
@@ -387,18 +399,18 @@ def create_interval_networks(interval_column, interval_type):
     interval_column = interval_column.astype(str)
     networks_dict['all'].add_node('all', color='red', shape='circle', level=0)
 
-    # create nodes from the patterns
-    for node in interval_column:
-        # create nodes according to the interval types
-        if interval_type == 'melodic':
-            nodes = re.sub(r'([+-])(?!$)', r'\1,', node).split(",")
-            separator = ''
-        elif interval_type == 'time':
-            nodes = node.split("/")
-            separator='/'
-        else:
-            raise Exception("Please put either 'time' or 'melodic' for `type_interval`")
+    # split every pattern into its intervals at once according to the interval types
+    if interval_type == 'melodic':
+        patterns = interval_column.str.replace(_MELODIC_SPLIT_RE, r'\1,', regex=True).str.split(",").tolist()
+        separator = ''
+    elif interval_type == 'time':
+        patterns = interval_column.str.split("/").tolist()
+        separator = '/'
+    else:
+        raise Exception("Please put either 'time' or 'melodic' for `type_interval`")
 
+    # create nodes from the patterns
+    for nodes in patterns:
         # nodes would be grouped according to the first interval
         group = nodes[0]
 
@@ -420,6 +432,19 @@ def create_interval_networks(interval_column, interval_type):
 
     return networks_dict
 
+def _highlight_search_pattern(df, search_pattern):
+    # color the string cells containing the search pattern one column at a time,
+    # other cells (e.g. the lists of segments) are never colored
+    found = np.zeros(df.shape, dtype=bool)
+    for i in range(df.shape[1]):
+        try:
+            contains = df.iloc[:, i].str.contains(search_pattern, regex=False)
+        except AttributeError:
+            # columns without any strings
+            continue
+        found[:, i] = contains.fillna(False).to_numpy(dtype=bool)
+    return pd.DataFrame(np.where(found, "background: #ccebc5", ""), index=df.index, columns=df.columns)
+
 def _manipulate_processed_network_df(df, interval_column, search_pattern_starts_with):
     """
     This method helps to generate interactive widget in create_interactive_compare_df
@@ -430,7 +455,8 @@ def _manipulate_processed_network_df(df, interval_column, search_pattern_starts_
     """
     mask = df[interval_column].astype(str).str.startswith(pat=search_pattern_starts_with)
     filtered_df = df[mask].copy()
-    return filtered_df.fillna("-").style.applymap(lambda x: "background: #ccebc5" if search_pattern_starts_with in x else "")
+    return filtered_df.fillna("-").style.apply(_highlight_search_pattern, axis=None,
+                                                search_pattern=search_pattern_starts_with)
 
 def create_interactive_compare_df(df, interval_column):
     """
@@ -471,8 +497,8 @@ def _trim_and_combine_piece_ids_with_measures(df):
             ]].copy()
 
     # combine ema and piece id
-    df['model_observation.ema'] = df['model_observation.ema'].str.split("/", n=1, expand=True)[0]
-    df['derivative_observation.ema'] = df['derivative_observation.ema'].str.split("/", n=1, expand=True)[0]
+    df['model_observation.ema'] = df['model_observation.ema'].str.split("/", n=1).str[0]
+    df['derivative_observation.ema'] = df['derivative_observation.ema'].str.split("/", n=1).str[0]
     df['model'] = df['model_observation.piece.piece_id'] + ":" + df['model_observation.ema']
     df['derivative'] = df['derivative_observation.piece.piece_id'] + ":" + df['derivative_observation.ema']
 
@@ -481,16 +507,38 @@ def _trim_and_combine_piece_ids_with_measures(df):
     return df
 
 def group_observations(model_series, derivative_series):
-    groups = {}
-    for i in model_series.index:
-        x = model_series.loc[i]
-        y = derivative_series.loc[i]
-        xset = groups.get(x.split(":")[0], set([x]))
-        yset = groups.get(y.split(":")[0], set([y]))
-        jset = xset | yset
-        for z in jset:
-            groups[z.split(":")[0]] = jset
-    return groups
+    """
+    Group observations into families of pieces connected by relationships.
+    :param model_series: column of model observations as 'piece_id:measures'
+    :param derivative_series: column of derivative observations as 'piece_id:measures'
+    :return: a dictionary mapping each piece id to the set of observations in its family
+    """
+    # encode the piece ids as integer codes, models first and then derivatives
+    observations = pd.concat([model_series, derivative_series], ignore_index=True)
+    codes, piece_ids = pd.factorize(observations.str.split(":", n=1).str[0])
+    if (codes < 0).any():
+        raise Exception("Missing model or derivative observations, please drop them before grouping")
+    model_codes = codes[:len(model_series)].tolist()
+    derivative_codes = codes[len(model_series):].tolist()
+
+    # union-find over the piece codes, each root stands for one family
+    parents = list(range(len(piece_ids)))
+
+    def find(code):
+        while parents[code] != code:
+            parents[code] = parents[parents[code]]
+            code = parents[code]
+        return code
+
+    for x, y in zip(model_codes, derivative_codes):
+        x_root, y_root = find(x), find(y)
+        if x_root != y_root:
+            parents[y_root] = x_root
+
+    # pieces of the same family share one set of observations
+    roots = np.array([find(code) for code in range(len(piece_ids))], dtype=int)
+    families = observations.groupby(roots[codes]).agg(set)
+    return {piece: families[root] for piece, root in zip(piece_ids, roots.tolist())}
 
 # TODO rename to something fancy
 def plot_relationship_network(df, color='derivative', selected_relationship_types=[], selected_model_ids=[],
@@ -500,13 +548,16 @@ def plot_relationship_network(df, color='derivative', selected_relationship_type
     df = _trim_and_combine_piece_ids_with_measures(df)
 
     # filter df according to users selected relationship_type,
-    # model_ids and derivative_ids
+    # model_ids and derivative_ids with one combined mask
+    mask = np.ones(len(df), dtype=bool)
     if selected_relationship_types:
-        df = df[df['relationship_type'].isin(selected_relationship_types)].dropna(how='all')
+        mask &= df['relationship_type'].isin(selected_relationship_types).to_numpy()
     if selected_model_ids:
-        df = df[df['model_observation.piece.piece_id'].isin(selected_model_ids)].dropna(how='all')
+        mask &= df['model_observation.piece.piece_id'].isin(selected_model_ids).to_numpy()
     if selected_derivative_ids:
-        df = df[df['derivative_observation.piece.piece_id'].isin(selected_derivative_ids)].dropna(how='all')
+        mask &= df['derivative_observation.piece.piece_id'].isin(selected_derivative_ids).to_numpy()
+    if not mask.all():
+        df = df[mask]
     if selected_families:
         families_dict = group_observations(df['model'], df['derivative'])
         relatives = set()
@@ -521,12 +572,13 @@ def plot_relationship_network(df, color='derivative', selected_relationship_type
         if gone_members:
             print(str(len(gone_members)) + " " + ", ".join(member for member in gone_members) +
                   " no longer exist in df because of other filtering options")
-        df = df[df['model'].isin(relatives) | df['derivative'].isin(relatives)].dropna(how='all')
+        df = df[df['model'].isin(relatives) | df['derivative'].isin(relatives)]
 
-    weights_dict = RELATIONSHIP_WEIGHTS
-    df['weight'] = df['relationship_type'].map(weights_dict,
-                                               na_action='ignore')
-    df['weight'].fillna(0, inplace=True)
+    # look up the weights by categorical codes, the trailing 0 is picked
+    # up by the -1 codes of unknown relationship types
+    codes = pd.Categorical(df['relationship_type'], categories=list(RELATIONSHIP_WEIGHTS)).codes
+    weights = np.append(np.fromiter(RELATIONSHIP_WEIGHTS.values(), dtype=int), 0)
+    df['weight'] = weights[codes]
 
     # construct the networks
     nt = Network(directed=True, notebook=True)
@@ -541,14 +593,16 @@ def plot_relationship_network(df, color='derivative', selected_relationship_type
     else:
         raise Exception("Invalid input for `color`, please put 'derivative' or 'model'.")
 
-    nt.add_nodes(df[normal_nodes_column])
+    # pull the columns out once, both loops below iterate over plain lists
+    relationship_types = df['relationship_type'].tolist()
+    nt.add_nodes(df[normal_nodes_column].tolist())
 
-    for row in df[colored_nodes_column].index:
-        nt.add_node(df[colored_nodes_column].loc[row], group=df['relationship_type'].loc[row])
+    for node, relationship_type in zip(df[colored_nodes_column].tolist(), relationship_types):
+        nt.add_node(node, group=relationship_type)
 
-    for row in df.index:
-        nt.add_edge(df['model'].loc[row], df['derivative'].loc[row],
-                    value=int(df['weight'].loc[row]), title=df['relationship_type'].loc[row])
+    for model, derivative, weight, relationship_type in zip(df['model'].tolist(), df['derivative'].tolist(),
+                                                            df['weight'].astype(int).tolist(), relationship_types):
+        nt.add_edge(model, derivative, value=weight, title=relationship_type)
     nt.inherit_edge_colors(color_inheritance)
 
     return nt
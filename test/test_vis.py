@@ -5,7 +5,9 @@ This file contains unit tests for visualizations.
 
 import altair as alt
 import pandas as pd
+import pytest
 import intervals.visualizations as viz
+import intervals.visualizations_demo as viz_demo
 
 from intervals.main_objs import CorpusBase
 from test_constants import EXAMPLE_CRIM_FILE, OBSERVATIONS_DICT_EXAMPLE, RELATIONSHIPS_DICT_EXAMPLE
@@ -168,12 +170,20 @@ def test_plot_close_match_heatmap():
 def test_comparisons_heatmap():
     # pieces
     df_relationships = pd.DataFrame(RELATIONSHIPS_DICT_EXAMPLE)
+    original_columns = df_relationships.columns.to_list()
     relationships_chart = viz.plot_comparison_heatmap(df_relationships, 'model_observation.ema',
                                                       main_category='relationship_type', other_category='observer.name',
                                                       heat_map_width=800, heat_map_height=300)
     assert isinstance(relationships_chart, alt.VConcatChart)
     assert len(relationships_chart.vconcat) == 2
 
+    # the heatmap has exactly one row per location in the ema addresses
+    # and the input dataframe is left untouched
+    locations_count = df_relationships['model_observation.ema'].str.split("/").str[0].str.count(",").sum() + \
+        len(df_relationships)
+    assert len(relationships_chart.vconcat[1].data) == locations_count
+    assert df_relationships.columns.to_list() == original_columns
+
     df_observations = pd.DataFrame(OBSERVATIONS_DICT_EXAMPLE)
     observations_chart = viz.plot_comparison_heatmap(df_observations, 'ema',
                                                      main_category='musical_type', other_category='observer.name',
@@ -182,6 +192,17 @@ def test_comparisons_heatmap():
     assert len(observations_chart.vconcat) == 2
 
 
+def test_process_network_df():
+    df_observations = pd.DataFrame(OBSERVATIONS_DICT_EXAMPLE)
+    network_df = viz.process_network_df(df_observations, 'mt_fg_int', 'ema')
+    assert network_df.columns.to_list() == ['piece.piece_id', 'url', 'mt_fg_int', 'segments']
+    assert network_df['segments'].to_list()[:3] == [['86-89'], ['148-150'], ['73-79']]
+
+    # several measure ranges are split into separate segments
+    df = pd.DataFrame({'piece.piece_id': ['A'], 'url': ['u'], 'mt_fg_int': ['-2+3'], 'ema': ['1-2,5-6/1,1/@all,@all']})
+    assert viz.process_network_df(df, 'mt_fg_int', 'ema')['segments'].to_list() == [['1-2', '5-6']]
+
+
 def test_generate_networks_and_interactive_df():
     df_observations = pd.DataFrame(OBSERVATIONS_DICT_EXAMPLE)
 
@@ -206,3 +227,58 @@ def test_generate_networks_and_interactive_df():
 
     assert fug_networks_filtered
     assert fug_widget_filtered
+
+
+def test_highlight_search_pattern():
+    df = pd.DataFrame({'mt_fg_int': ['-2+3', '+4-2', '-'],
+                       'segments': [['11-13'], ['-1'], ['1-2']],
+                       'count': [1, 11, 2]})
+    styles = viz._highlight_search_pattern(df, '-')
+    assert styles['mt_fg_int'].to_list() == ["background: #ccebc5"] * 3
+    # list and numeric cells are never highlighted
+    assert (styles[['segments', 'count']] == "").all(axis=None)
+
+    df_observations = pd.DataFrame(OBSERVATIONS_DICT_EXAMPLE)
+    network_df = viz.process_network_df(df_observations, 'mt_fg_int', 'ema').fillna("-")
+    for search_pattern in ('', '1', '-1'):
+        styles = viz._highlight_search_pattern(network_df, search_pattern)
+        assert (styles['segments'] == "").all()
+
+
+def test_group_observations_missing_observation():
+    models = pd.Series(['A:1', float('nan'), 'C:3'])
+    derivatives = pd.Series(['B:5', 'C:6', 'D:7'])
+    with pytest.raises(Exception):
+        viz_demo.group_observations(models, derivatives)
+
+
+def test_comparisons_heatmap_missing_ema():
+    df = pd.DataFrame({'id': [1, 2, 3],
+                       'url': ['http://crimproject.org/data/observations/{}/'.format(i) for i in range(1, 4)],
+                       'ema': ['1-2,5-6/1,1/@all,@all', '3/1/@all', float('nan')],
+                       'musical_type': ['a', 'b', 'a'],
+                       'observer.name': ['x', 'y', 'x']})
+    for module in (viz, viz_demo):
+        # the observation without an ema address is kept without locations
+        offsets = module._from_ema_to_offsets(df, 'ema')
+        assert offsets['id'].to_list() == [1, 1, 2, 3]
+        assert offsets['locations'].isna().to_list() == [False, False, False, True]
+
+        chart = module.plot_comparison_heatmap(df, 'ema')
+        # both bar charts share the category counts, which altair lifts onto the hconcat
+        counts = chart.vconcat[0].data.groupby('musical_type')['count'].sum()
+        assert counts.to_dict() == {'a': 3, 'b': 1}
+
+
+def test_group_observations():
+    models = pd.Series(['A:1', 'B:2', 'C:3', 'A:4'])
+    derivatives = pd.Series(['B:5', 'C:6', 'D:7', 'E:8'])
+    families = viz_demo.group_observations(models, derivatives)
+
+    # every piece linked by a relationship shares the whole family,
+    # including observations of pieces that were grouped earlier
+    family = {'A:1', 'B:2', 'C:3', 'A:4', 'B:5', 'C:6', 'D:7', 'E:8'}
+    assert families == {piece: family for piece in 'ABCDE'}
+
+    families = viz_demo.group_observations(pd.Series(['A:1', 'C:3']), pd.Series(['B:2', 'D:4']))
+    assert families == {'A': {'A:1', 'B:2'}, 'B': {'A:1', 'B:2'}, 'C': {'C:3', 'D:4'}, 'D': {'C:3', 'D:4'}}